@@ -32,6 +32,12 @@ parser.add_argument("--text", type=str, default="a photo of a {}", help="Prompt
 parser.add_argument("--negative_prompt", type=str, default=None, help="Prompt template for negative images")
 parser.add_argument("--num_of_samples", type=int, default=None, help="Number of samples to generate")
 parser.add_argument("--from_noised_image", action="store_true", help="Use noised image as input")
+parser.add_argument("--mixed_precision", type=str, default="no", choices=["no", "fp16", "bf16"],
+                    help="Precision of the U-Net, image encoder and adapters. The VAE always runs in float32")
+parser.add_argument("--trust_legacy_checkpoint", action="store_true",
+                    help="Allow fully unpickling an older checkpoint that fails to load with weights_only=True. "
+                         "Only use it with checkpoints from a trusted source")
+parser.add_argument("--compile", action="store_true", help="Compile the U-Net, VAE decoder and adapters with torch.compile")
 
 
 def preprocess_image_for_inference(image_path, tokenizer, template="a photo of a {}",
@@ -66,9 +72,12 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch_dtype = {"no": None, "fp16": torch.float16, "bf16": torch.bfloat16}[args.mixed_precision]
 
     tokenizer, text_encoder, vae, unet, image_encoder, image_adapter, text_adapter, scheduler, _ = load_models(
-        args.model_path, args.extra_num_tokens, args.checkpoint_path)
+        args.model_path, args.extra_num_tokens, args.checkpoint_path,
+        compile_unet=args.compile, compile_vae=args.compile, compile_adapters=args.compile, torch_dtype=torch_dtype,
+        merge_lora=True, trust_legacy_checkpoint=args.trust_legacy_checkpoint)
 
     vae.to(device)
     unet.to(device)
@@ -78,6 +87,9 @@ if __name__ == "__main__":
     text_adapter.to(device)
 
     example = preprocess_image_for_inference(args.input_image_path, tokenizer, template=args.text, num_of_samples= args.num_of_samples,negative_prompt=args.negative_prompt)
+    if device.type == "cuda":
+        # Pinned host memory lets run_inference copy the inputs to the GPU asynchronously
+        example = {key: value.pin_memory() if torch.is_tensor(value) else value for key, value in example.items()}
 
     with torch.no_grad():
         generated_images = run_inference(
@@ -8,6 +8,7 @@ docker run -it --gpus all \
   photoverse:base \
   python generate.py \
   --checkpoint_path final3_photoverse_facenet_lora_rank128/photoverse_040000.pt \
+  --trust_legacy_checkpoint \
   --input_image_path input_image.png \
   --guidance_scale 6 \
   --num_timesteps 25 \
@@ -1,7 +1,97 @@
+import math
+
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 
+class BatchedLinear(nn.Module):
+    """
+    A stack of independent linear layers, applied to a stack of inputs with a single batched matmul.
+
+    Args:
+        num_layers (int): Number of stacked linear layers.
+        in_features (int): Size of each input sample.
+        out_features (int): Size of each output sample.
+    """
+
+    def __init__(self, num_layers, in_features, out_features):
+        super(BatchedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.empty(num_layers, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(num_layers, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same initialization as nn.Linear, for every layer in the stack
+        bound = 1 / math.sqrt(self.weight.shape[-1])
+        for weight in self.weight:
+            nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x, layers=slice(None)):
+        # x: [num_layers, N, in_features] -> [num_layers, N, out_features]
+        return torch.baddbmm(self.bias[layers].unsqueeze(1), x, self.weight[layers].transpose(1, 2))
+
+
+class BatchedLayerNormLeakyReLU(nn.Module):
+    """
+    A stack of independent layer norms over the last dimension, one per layer of the input stack, fused with the
+    LeakyReLU that follows them. Compiling it (see `PhotoVerseAdapter.compile_fused_layers`) turns the normalization,
+    affine transform and activation into a single kernel.
+
+    Args:
+        num_layers (int): Number of stacked layer norms.
+        normalized_shape (int): Size of the normalized dimension.
+        eps (float): Value added to the denominator for numerical stability. Default is 1e-5.
+        negative_slope (float): Negative slope of the LeakyReLU. Default is 0.01.
+    """
+
+    def __init__(self, num_layers, normalized_shape, eps=1e-5, negative_slope=0.01):
+        super(BatchedLayerNormLeakyReLU, self).__init__()
+        self.normalized_shape = (normalized_shape,)
+        self.eps = eps
+        self.negative_slope = negative_slope
+        self.weight = nn.Parameter(torch.ones(num_layers, normalized_shape))
+        self.bias = nn.Parameter(torch.zeros(num_layers, normalized_shape))
+
+    def forward(self, x, layers=slice(None)):
+        x = F.layer_norm(x, self.normalized_shape, eps=self.eps)
+        x = torch.addcmul(self.bias[layers].unsqueeze(1), x, self.weight[layers].unsqueeze(1))
+        return F.leaky_relu(x, self.negative_slope)
+
+
+class BatchedMLP(nn.Module):
+    """
+    A stack of independent `Linear -> LayerNorm -> LeakyReLU -> Linear -> LayerNorm -> LeakyReLU -> Linear` MLPs.
+
+    Args:
+        num_layers (int): Number of stacked MLPs.
+        in_features (int): Size of each input sample.
+        hidden_features (int): Size of the hidden layers.
+        out_features (int): Size of each output sample.
+    """
+
+    def __init__(self, num_layers, in_features, hidden_features, out_features):
+        super(BatchedMLP, self).__init__()
+        self.linear_1 = BatchedLinear(num_layers, in_features, hidden_features)
+        self.norm_1 = BatchedLayerNormLeakyReLU(num_layers, hidden_features)
+        self.linear_2 = BatchedLinear(num_layers, hidden_features, hidden_features)
+        self.norm_2 = BatchedLayerNormLeakyReLU(num_layers, hidden_features)
+        self.linear_3 = BatchedLinear(num_layers, hidden_features, out_features)
+
+    def forward_hidden(self, x, layers=slice(None)):
+        # Everything but the last linear layer
+        x = self.norm_1(self.linear_1(x, layers), layers)
+        return self.norm_2(self.linear_2(x, layers), layers)
+
+    def forward(self, x, layers=slice(None)):
+        return self.linear_3(self.forward_hidden(x, layers), layers)
+
+
+# Maps the nn.Sequential indices of the per-token mappings in older checkpoints to the fused layers
+_LEGACY_MAPPING_LAYERS = {0: "linear_1", 1: "norm_1", 3: "linear_2", 4: "norm_2", 6: "linear_3"}
+
+
 class PhotoVerseAdapter(nn.Module):
     def __init__(self,
                  clip_embedding_dim=1024,
@@ -9,36 +99,50 @@ class PhotoVerseAdapter(nn.Module):
                  num_tokens=5
                  ):
         super(PhotoVerseAdapter, self).__init__()
+        self.num_tokens = num_tokens
+
+        # One MLP per token for the class embedding and one for the patch embeddings, all tokens run in one batch
+        self.mapping = BatchedMLP(num_tokens, clip_embedding_dim, 1024, cross_attention_dim)
+        self.mapping_patch = BatchedMLP(num_tokens, clip_embedding_dim, 1024, cross_attention_dim)
 
-        for i in range(num_tokens):
-            setattr(self, f'mapping_{i}', nn.Sequential(nn.Linear(clip_embedding_dim, 1024),
-                                                        nn.LayerNorm(1024),
-                                                        nn.LeakyReLU(),
-                                                        nn.Linear(1024, 1024),
-                                                        nn.LayerNorm(1024),
-                                                        nn.LeakyReLU(),
-                                                        nn.Linear(1024, cross_attention_dim)))
-
-            setattr(self, f'mapping_patch_{i}', nn.Sequential(nn.Linear(clip_embedding_dim, 1024),
-                                                              nn.LayerNorm(1024),
-                                                              nn.LeakyReLU(),
-                                                              nn.Linear(1024, 1024),
-                                                              nn.LayerNorm(1024),
-                                                              nn.LeakyReLU(),
-                                                              nn.Linear(1024, cross_attention_dim)))
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints hold a separate `mapping_{i}` / `mapping_patch_{i}` nn.Sequential per token
+        for branch in ("mapping", "mapping_patch"):
+            for legacy_idx, layer_name in _LEGACY_MAPPING_LAYERS.items():
+                for param_name in ("weight", "bias"):
+                    legacy_keys = [f"{prefix}{branch}_{i}.{legacy_idx}.{param_name}" for i in range(self.num_tokens)]
+                    if all(key in state_dict for key in legacy_keys):
+                        state_dict[f"{prefix}{branch}.{layer_name}.{param_name}"] = torch.stack(
+                            [state_dict.pop(key) for key in legacy_keys])
+        super(PhotoVerseAdapter, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def compile_fused_layers(self, **compile_kwargs):
+        """
+        Compiles the fused LayerNorm + LeakyReLU layers in place with torch.compile. Parameter names are unchanged.
+        """
+        for module in self.modules():
+            if isinstance(module, BatchedLayerNormLeakyReLU):
+                module.compile(**compile_kwargs)
 
     def forward(self, embs, token_index=None):
-        hidden_states = ()
         if token_index is not None and token_index != 'full':
             token_index = int(token_index)
-            embs = embs[token_index]
-            hidden_state = getattr(self, f'mapping_{token_index}')(embs[:, :1]) + getattr(self, f'mapping_patch_{token_index}')(
-                embs[:, 1:]).mean(dim=1, keepdim=True)
-            return hidden_state
-
-        for i, emb in enumerate(embs):
-            hidden_state = getattr(self, f'mapping_{i}')(emb[:, :1]) + getattr(self, f'mapping_patch_{i}')(
-                emb[:, 1:]).mean(dim=1, keepdim=True)
-            hidden_states += (hidden_state,)
-        hidden_states = torch.cat(hidden_states, dim=1)
-        return hidden_states
+            layers = slice(token_index, token_index + 1)
+            embs = embs[token_index].unsqueeze(0)
+        else:
+            layers = slice(0, len(embs))
+            embs = torch.stack(embs)
+
+        # embs: [num_tokens, batch_size, seq_len, clip_embedding_dim]
+        num_tokens, batch_size, seq_len, _ = embs.shape
+        hidden_states = self.mapping(embs[:, :, 0], layers)
+        patch_hidden_states = self.mapping_patch.forward_hidden(
+            embs[:, :, 1:].reshape(num_tokens, batch_size * (seq_len - 1), -1), layers)
+        # The last layer is affine, so averaging the patches before it gives the same result on a single token
+        patch_hidden_states = patch_hidden_states.view(num_tokens, batch_size, seq_len - 1, -1).mean(dim=2)
+        patch_hidden_states = self.mapping_patch.linear_3(patch_hidden_states, layers)
+
+        # Write both branches straight into a preallocated [batch_size, num_tokens, cross_attention_dim] output
+        output = hidden_states.new_empty((batch_size, num_tokens, hidden_states.shape[-1]))
+        output.transpose(0, 1).copy_(hidden_states).add_(patch_hidden_states)
+        return output
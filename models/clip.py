@@ -1,4 +1,7 @@
+import types
+
 import torch
+import torch.nn.functional as F
 import torch.utils.checkpoint
 from transformers.modeling_attn_mask_utils import _create_4d_causal_attention_mask, _prepare_4d_attention_mask
 
@@ -117,3 +120,47 @@ def patch_clip_text_transformer(text_encoder):
         if _module.__class__.__name__ == "CLIPTextTransformer":
             _module.__class__.__call__ = clip_text_transformer_forward
     return text_encoder
+
+
+def clip_attention_sdpa_forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        causal_attention_mask: Optional[torch.Tensor] = None,
+        output_attentions: Optional[bool] = False,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    # the fused kernels do not return the attention weights
+    if output_attentions:
+        return self.__class__.forward(self, hidden_states, attention_mask, causal_attention_mask, output_attentions)
+
+    bsz, tgt_len, embed_dim = hidden_states.size()
+
+    query_states = self.q_proj(hidden_states).view(bsz, tgt_len, self.num_heads, self.head_dim).transpose(1, 2)
+    key_states = self.k_proj(hidden_states).view(bsz, tgt_len, self.num_heads, self.head_dim).transpose(1, 2)
+    value_states = self.v_proj(hidden_states).view(bsz, tgt_len, self.num_heads, self.head_dim).transpose(1, 2)
+
+    # a plain causal mask is passed as `is_causal`, so the flash attention kernel can still be dispatched
+    is_causal = causal_attention_mask is not None and attention_mask is None
+    if is_causal:
+        attention_mask = None
+    elif causal_attention_mask is not None:
+        attention_mask = attention_mask + causal_attention_mask
+
+    attn_output = F.scaled_dot_product_attention(
+        query_states, key_states, value_states, attn_mask=attention_mask,
+        dropout_p=self.dropout if self.training else 0.0, is_causal=is_causal
+    )
+
+    attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, embed_dim)
+    attn_output = self.out_proj(attn_output)
+
+    return attn_output, None
+
+
+def patch_clip_attention_sdpa(clip_model):
+    if not hasattr(F, "scaled_dot_product_attention"):
+        return clip_model
+    for _module in clip_model.modules():
+        if _module.__class__.__name__ == "CLIPAttention":
+            _module.forward = types.MethodType(clip_attention_sdpa_forward, _module)
+    return clip_model
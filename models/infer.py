@@ -1,9 +1,151 @@
 from diffusers import DPMSolverMultistepScheduler
+import contextlib
+import functools
 import torch
 
 from tqdm import tqdm
 
 
+# Maximum number of blank image feature sets kept on the image encoder
+_UNCOND_CACHE_MAX_SIZE = 8
+
+
+@functools.lru_cache(maxsize=None)
+def _get_copy_stream(device):
+    return torch.cuda.Stream(device)
+
+
+def _copy_to_device(example, keys, device):
+    """
+    Copies the given example tensors to the device, skipping missing or `None` entries. On CUDA, the host-to-device
+    copies are issued without blocking on a side stream, so they overlap with queued work when the source tensors are
+    pinned, and the current stream only waits for them before their first use.
+    """
+    device = torch.device(device)
+    if device.type != "cuda":
+        return {key: example[key].to(device) for key in keys if example.get(key) is not None}
+
+    current_stream = torch.cuda.current_stream(device)
+    copy_stream = _get_copy_stream(device)
+    with torch.cuda.stream(copy_stream):
+        tensors = {key: example[key].to(device, non_blocking=True) for key in keys if example.get(key) is not None}
+    current_stream.wait_stream(copy_stream)
+    for tensor in tensors.values():
+        tensor.record_stream(current_stream)
+    return tensors
+
+
+def _warmup_compiled_unet(unet, latents, t, encoder_hidden_states, autocast_enabled=False):
+    """
+    Runs a single dummy denoising step through a compiled U-Net, once per input shapes and autocast state, so graph
+    capture does not happen inside the denoising loop. Must be called under the same autocast context as the loop,
+    since the compiled graph is guarded on it.
+    """
+    if not hasattr(unet, "_orig_mod"):
+        return
+    warmed_up_shapes = getattr(unet, "_warmed_up_shapes", set())
+    shape_key = (tuple(latents.shape), latents.dtype, tuple(tuple(h.shape) for h in encoder_hidden_states),
+                 autocast_enabled)
+    if shape_key in warmed_up_shapes:
+        return
+    with torch.no_grad():
+        unet(torch.zeros_like(latents), t, encoder_hidden_states=encoder_hidden_states)
+    warmed_up_shapes.add(shape_key)
+    unet._warmed_up_shapes = warmed_up_shapes
+
+
+@functools.lru_cache(maxsize=8)
+def _get_inference_scheduler(scheduler, timesteps, device):
+    """
+    Builds the DPM-Solver scheduler for the given training scheduler, number of timesteps and device once. Its
+    timesteps live on the device, so feeding them to the U-Net needs no host-to-device copy. It is created outside
+    inference mode, so it can be reused by training mode calls.
+    """
+    with torch.inference_mode(False):
+        inference_scheduler = DPMSolverMultistepScheduler.from_config(scheduler.config)
+        inference_scheduler.set_timesteps(timesteps, device=device)
+    return inference_scheduler
+
+
+def _reset_scheduler_state(scheduler):
+    """
+    Clears the per-run state of a cached multistep scheduler, keeping its timesteps and sigmas.
+    """
+    scheduler.model_outputs = [None] * scheduler.config.solver_order
+    scheduler.lower_order_nums = 0
+    scheduler._step_index = None
+    scheduler._begin_index = None
+
+
+@contextlib.contextmanager
+def _scheduler_run(scheduler):
+    """
+    Clears the per-run state of a cached scheduler before and after a run, so it does not keep the last run's model
+    outputs, and with them their autograd graph after a training mode call, alive until the next run.
+    """
+    _reset_scheduler_state(scheduler)
+    try:
+        yield scheduler
+    finally:
+        _reset_scheduler_state(scheduler)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_uncond_input_ids(tokenizer, batch_size, device):
+    """
+    Tokenizes the empty prompt once per tokenizer, batch size and device. The ids are created outside inference
+    mode, so they can be reused by training mode calls.
+    """
+    with torch.inference_mode(False):
+        return tokenizer(
+            [''] * batch_size,
+            padding="max_length",
+            max_length=tokenizer.model_max_length,
+            return_tensors="pt",
+        ).input_ids.to(device)
+
+
+def _encode_reference_images(image_encoder, pixel_values_clip, image_encoder_layers_idx, encode_uncond=True):
+    """
+    Encodes the reference images and, if `encode_uncond` is set, the blank unconditional image, returning the
+    selected hidden states of both.
+
+    The blank image features do not depend on the example, so they are cached on the (frozen) image encoder per
+    image shape, device and dtype. On a cache miss, the blank image is encoded in the same batch as the references.
+    """
+    def select_hidden_states(image_features):
+        return [image_features[0]] + [image_features[2][i] for i in image_encoder_layers_idx if
+                                      i < len(image_features[2])]
+
+    if not encode_uncond:
+        with torch.no_grad():
+            return select_hidden_states(image_encoder(pixel_values_clip, output_hidden_states=True)), None
+
+    if not hasattr(image_encoder, "_uncond_cache"):
+        image_encoder._uncond_cache = {}
+    batch_size = pixel_values_clip.shape[0]
+    # Layer indices may come in as a tensor (see train.py), whose elements would hash by identity
+    cache_key = (tuple(pixel_values_clip.shape[1:]), pixel_values_clip.device, pixel_values_clip.dtype,
+                 tuple(int(i) for i in image_encoder_layers_idx))
+    uncond_image_embeddings = image_encoder._uncond_cache.get(cache_key)
+
+    with torch.no_grad():
+        if uncond_image_embeddings is None:
+            # Cached tensors are created outside inference mode, so they can be reused by training mode calls
+            with torch.inference_mode(False):
+                pixel_values_clip = torch.cat([pixel_values_clip, torch.zeros_like(pixel_values_clip[:1])])
+                hidden_states = select_hidden_states(image_encoder(pixel_values_clip, output_hidden_states=True))
+                image_embeddings = [emb[:batch_size] for emb in hidden_states]
+                uncond_image_embeddings = [emb[batch_size:].clone() for emb in hidden_states]
+            if len(image_encoder._uncond_cache) >= _UNCOND_CACHE_MAX_SIZE:
+                image_encoder._uncond_cache.pop(next(iter(image_encoder._uncond_cache)))
+            image_encoder._uncond_cache[cache_key] = uncond_image_embeddings
+        else:
+            image_embeddings = select_hidden_states(image_encoder(pixel_values_clip, output_hidden_states=True))
+
+    return image_embeddings, [emb.expand(batch_size, -1, -1) for emb in uncond_image_embeddings]
+
+
 def run_inference(example, tokenizer, image_encoder, text_encoder, unet, text_adapter, image_adapter, vae, scheduler,
                   device, image_encoder_layers_idx, latent_size=64, guidance_scale=1, timesteps=100, token_index=0,
                   disable_tqdm=False, seed=None, from_noised_image=False, training_mode=False):
@@ -35,89 +177,132 @@ def run_inference(example, tokenizer, image_encoder, text_encoder, unet, text_ad
         torch.Tensor: Generated images.
     """
 
-    # Load and set the scheduler
-    scheduler = DPMSolverMultistepScheduler.from_config(scheduler.config)
-    scheduler.set_timesteps(timesteps)
-
-    # Create the unconditional input ids
-    uncond_input_ids = example.get("negative_text_input_ids", None)
-    uncond_input_ids = tokenizer(
-        [''] * example["pixel_values"].shape[0],
-        padding="max_length",
-        max_length=tokenizer.model_max_length,
-        return_tensors="pt",
-    ).input_ids if uncond_input_ids is None else uncond_input_ids
-
-    # Create the noise
-    if seed is None:
-        noise = torch.randn(
-            (example["pixel_values"].shape[0], unet.config.in_channels, latent_size, latent_size)
-        ).to(device)
-    else:
-        generator = torch.manual_seed(seed)
-        noise = torch.randn(
-            (example["pixel_values"].shape[0], unet.config.in_channels, latent_size, latent_size), generator=generator).to(device)
-
-    # Setup the latent depending if we are using the noised image or not
-    if from_noised_image:
-        latents = vae.encode(example["pixel_values"].to(device)).latent_dist.sample().detach()
-        latents = latents * vae.config.scaling_factor
-        latents = scheduler.add_noise(latents, noise, scheduler.timesteps[:1].repeat(latents.shape[0]))
-
-    else:
-        latents = noise
-
-    latents = latents * scheduler.init_noise_sigma
-
-    placeholder_idx = example["concept_placeholder_idx"].to(device)
-    pixel_values_clip = example["pixel_values_clip"].to(device)
-
-    # get conditional image embeddings and text embeddings
-    image_features = image_encoder(pixel_values_clip, output_hidden_states=True)
-    uncond_image_features = image_encoder(torch.zeros_like(example["pixel_values_clip"]).to(device),
-                                          output_hidden_states=True)
-
-    image_embeddings = [image_features[0]] + [image_features[2][i] for i in image_encoder_layers_idx if
-                                              i < len(image_features[2])]
-    uncond_image_emmbedings = [uncond_image_features[0]] + [uncond_image_features[2][i] for i in
-                                                            image_encoder_layers_idx if
-                                                            i < len(uncond_image_features[2])]
-
-    image_embeddings = [emb.detach() for emb in image_embeddings]
-    uncond_image_emmbedings = [emb.detach() for emb in uncond_image_emmbedings]
-
-    concept_text_embeddings = text_adapter(image_embeddings, token_index=token_index)
-    encoder_hidden_states_image = image_adapter(image_embeddings, token_index=token_index)
-    uncond_encoder_hidden_states_image = image_adapter(uncond_image_emmbedings, token_index=token_index)
-
-    uncond_embeddings = text_encoder({'text_input_ids': uncond_input_ids.to(device)})[0]
-    encoder_hidden_states = text_encoder({'text_input_ids': example["text_input_ids"].to(device),
-                                          "concept_text_embeddings": concept_text_embeddings,
-                                          "concept_placeholder_idx": placeholder_idx})[0]
-
-    for i, t in enumerate(tqdm(scheduler.timesteps, desc="Denoising", disable=disable_tqdm)):
-        with torch.set_grad_enabled(training_mode and (i == len(scheduler.timesteps) - 1)):
-            latent_model_input = scheduler.scale_model_input(latents, t)
-
-            # Noise prediction based on unconditional inputs
-            noise_pred_uncond = unet(
-                latent_model_input,
-                t,
-                encoder_hidden_states=(uncond_embeddings, uncond_encoder_hidden_states_image)
-            ).sample
-
-            # Noise prediction based on conditional inputs (text + image)
-            noise_pred_text = unet(
-                latent_model_input,
-                t,
-                encoder_hidden_states=(encoder_hidden_states, encoder_hidden_states_image)
-            ).sample
-
-            noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-            # compute the previous noisy sample x_t -> x_t-1
-            latents = scheduler.step(noise_pred, t, latents).prev_sample
-
-    _latents = 1 / vae.config.scaling_factor * latents.clone()
-    images = vae.decode(_latents).sample.clamp(-1, 1)
-    return images
\ No newline at end of file
+    # Load and set the scheduler, its per-run state is cleared again once the run is done
+    scheduler = _get_inference_scheduler(scheduler, timesteps, torch.device(device))
+
+    # Outside of training, nothing here needs autograd, so skip its bookkeeping entirely
+    with torch.inference_mode(not training_mode), _scheduler_run(scheduler):
+        # Start the host-to-device copies first, they only have to be done by the first use of the inputs
+        input_keys = ["pixel_values_clip", "text_input_ids", "concept_placeholder_idx", "negative_text_input_ids"]
+        if from_noised_image:
+            input_keys.append("pixel_values")
+        inputs = _copy_to_device(example, input_keys, device)
+
+        # Create the unconditional input ids
+        uncond_input_ids = inputs.get("negative_text_input_ids", None)
+        if uncond_input_ids is None:
+            uncond_input_ids = _get_uncond_input_ids(tokenizer, example["pixel_values"].shape[0], device)
+
+        # Create the noise, channels last like the U-Net and VAE weights
+        if seed is None:
+            noise = torch.randn(
+                (example["pixel_values"].shape[0], unet.config.in_channels, latent_size, latent_size)
+            ).to(device, memory_format=torch.channels_last)
+        else:
+            generator = torch.manual_seed(seed)
+            noise = torch.randn(
+                (example["pixel_values"].shape[0], unet.config.in_channels, latent_size, latent_size), generator=generator).to(device, memory_format=torch.channels_last)
+
+        # Setup the latent depending if we are using the noised image or not
+        if from_noised_image:
+            latents = vae.encode(inputs["pixel_values"].to(dtype=vae.dtype)).latent_dist.sample().detach()
+            latents = latents * vae.config.scaling_factor
+            latents = scheduler.add_noise(latents, noise, scheduler.timesteps[:1].repeat(latents.shape[0]))
+
+        else:
+            latents = noise
+
+        latents = latents * scheduler.init_noise_sigma
+
+        placeholder_idx = inputs["concept_placeholder_idx"]
+        pixel_values_clip = inputs["pixel_values_clip"].to(dtype=image_encoder.dtype)
+
+        # Without guidance the unconditional prediction cancels out, so the unconditional inputs are not needed
+        do_classifier_free_guidance = guidance_scale != 1
+
+        # get conditional image embeddings and text embeddings
+        image_embeddings, uncond_image_emmbedings = _encode_reference_images(
+            image_encoder, pixel_values_clip, image_encoder_layers_idx, encode_uncond=do_classifier_free_guidance)
+
+        concept_text_embeddings = text_adapter(image_embeddings, token_index=token_index)
+        encoder_hidden_states_image = image_adapter(image_embeddings, token_index=token_index)
+        encoder_hidden_states = text_encoder({'text_input_ids': inputs["text_input_ids"],
+                                              "concept_text_embeddings": concept_text_embeddings,
+                                              "concept_placeholder_idx": placeholder_idx})[0]
+
+        cond_unet_encoder_hidden_states = (encoder_hidden_states.to(unet.dtype), encoder_hidden_states_image.to(unet.dtype))
+
+        # With guidance, the unconditional and conditional inputs share a single batched U-Net forward pass
+        if do_classifier_free_guidance:
+            uncond_encoder_hidden_states_image = image_adapter(uncond_image_emmbedings, token_index=token_index)
+            uncond_embeddings = text_encoder({'text_input_ids': uncond_input_ids})[0]
+
+            uncond_unet_encoder_hidden_states = (uncond_embeddings.to(unet.dtype),
+                                                 uncond_encoder_hidden_states_image.to(unet.dtype))
+            unet_encoder_hidden_states = tuple(
+                torch.cat([uncond, cond]) for uncond, cond in
+                zip(uncond_unet_encoder_hidden_states, cond_unet_encoder_hidden_states)
+            )
+        else:
+            unet_encoder_hidden_states = cond_unet_encoder_hidden_states
+
+        # A half precision U-Net runs under autocast, while the latents and the scheduler math stay in float32
+        autocast_enabled = unet.dtype in (torch.float16, torch.bfloat16)
+        autocast = torch.autocast(device_type=torch.device(device).type, dtype=unet.dtype, enabled=autocast_enabled)
+
+        # Static buffers keep the U-Net inputs at fixed addresses across steps, so CUDA graphs can be replayed
+        batch_size = latents.shape[0]
+        latent_model_input = torch.empty(
+            ((2 if do_classifier_free_guidance else 1) * batch_size, *latents.shape[1:]), dtype=unet.dtype,
+            device=latents.device, memory_format=torch.channels_last)
+        timestep = torch.zeros((), dtype=scheduler.timesteps.dtype, device=device)
+
+        with autocast:
+            _warmup_compiled_unet(unet, latent_model_input, timestep, unet_encoder_hidden_states, autocast_enabled)
+
+        for i, t in enumerate(tqdm(scheduler.timesteps, desc="Denoising", disable=disable_tqdm)):
+            with torch.set_grad_enabled(training_mode and (i == len(scheduler.timesteps) - 1)), autocast:
+                timestep.copy_(t)
+                scaled_latents = scheduler.scale_model_input(latents, t)
+
+                if do_classifier_free_guidance and torch.is_grad_enabled():
+                    # With grad enabled, the attention processors draw a random fusion rule per call, so the
+                    # unconditional and conditional predictions keep separate U-Net calls, each with its own draw
+                    scaled_latents = scaled_latents.to(unet.dtype)
+                    noise_pred_uncond = unet(
+                        scaled_latents,
+                        timestep,
+                        encoder_hidden_states=uncond_unet_encoder_hidden_states
+                    ).sample.to(latents.dtype)
+                    noise_pred_text = unet(
+                        scaled_latents,
+                        timestep,
+                        encoder_hidden_states=cond_unet_encoder_hidden_states
+                    ).sample.to(latents.dtype)
+                else:
+                    latent_model_input[:batch_size].copy_(scaled_latents)
+                    if do_classifier_free_guidance:
+                        latent_model_input[batch_size:].copy_(scaled_latents)
+
+                    noise_pred = unet(
+                        latent_model_input,
+                        timestep,
+                        encoder_hidden_states=unet_encoder_hidden_states
+                    ).sample.to(latents.dtype)
+
+                    if do_classifier_free_guidance:
+                        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+
+                if do_classifier_free_guidance:
+                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+                # compute the previous noisy sample x_t -> x_t-1
+                prev_sample = scheduler.step(noise_pred, t, latents).prev_sample
+                if torch.is_grad_enabled():
+                    latents = prev_sample
+                else:
+                    latents.copy_(prev_sample)
+
+        _latents = 1 / vae.config.scaling_factor * latents
+        images = vae.decode(_latents.to(vae.dtype)).sample.clamp(-1, 1)
+        return images
\ No newline at end of file
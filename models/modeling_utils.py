@@ -1,40 +1,88 @@
 from diffusers import AutoencoderKL, UNet2DConditionModel, DDPMScheduler
 from peft import LoraConfig, inject_adapter_in_model
+from peft.tuners.lora import LoraLayer
+from enum import Enum
+import logging
+import pickle
 import torch
 import os
+import re
 
 from models.adapters import PhotoVerseAdapter
-from models.clip import patch_clip_text_transformer
+from models.clip import patch_clip_text_transformer, patch_clip_attention_sdpa
 from models.unet import set_visual_cross_attention_adapter
 
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPVisionModel
 
-
-def load_photoverse_model(path, image_adapter, text_adapter, unet):
-    state_dict = torch.load(path, map_location="cpu")
+logger = logging.getLogger(__name__)
+
+# U-Net parameters saved in the checkpoints: the visual cross attention processors and the (LoRA) textual projections
+CROSS_ATTENTION_PARAMETERS_PATTERN = re.compile(r"\.attn2\.(processor|to_q|to_k|to_v)\.")
+
+
+def load_photoverse_model(path, image_adapter, text_adapter, unet, trust_legacy_checkpoint=False):
+    # Memory map the checkpoint and assign its tensors to the modules directly, instead of copying them
+    try:
+        state_dict = torch.load(path, map_location="cpu", weights_only=True, mmap=True)
+    except pickle.UnpicklingError as e:
+        # older checkpoints store the LoRA config with peft types, which the weights only unpickler rejects
+        if not trust_legacy_checkpoint:
+            raise pickle.UnpicklingError(
+                f"{path} cannot be loaded with `weights_only=True`. If it is a trusted checkpoint saved by an older "
+                f"version of this repo, load it once with `trust_legacy_checkpoint=True` (--trust_legacy_checkpoint) "
+                f"and re-save it with `save_progress`, which stores the LoRA config with builtin types only."
+            ) from e
+        logger.warning(f"Loading {path} with `weights_only=False`, since `trust_legacy_checkpoint` is set. This runs "
+                       f"arbitrary code from the checkpoint, only use it with checkpoints from a trusted source.")
+        state_dict = torch.load(path, map_location="cpu", weights_only=False, mmap=True)
     lora_config = None
     if "lora_config" in state_dict:
         lora_config = LoraConfig(**state_dict["lora_config"])
         unet = inject_adapter_in_model(lora_config, unet)
     if "image_adapter" in state_dict:
-        image_adapter.load_state_dict(state_dict["image_adapter"])
+        image_adapter.load_state_dict(state_dict["image_adapter"], assign=True)
     if "text_adapter" in state_dict:
-        text_adapter.load_state_dict(state_dict["text_adapter"])
+        text_adapter.load_state_dict(state_dict["text_adapter"], assign=True)
     if "cross_attention_adapter" in state_dict:
-        unet.load_state_dict(state_dict["cross_attention_adapter"], strict=False)
+        unet.load_state_dict(state_dict["cross_attention_adapter"], strict=False, assign=True)
 
     return image_adapter, text_adapter, unet, lora_config
 
 
+def merge_lora_weights(unet):
+    """
+    Folds the LoRA deltas into their base linear layers and swaps the LoRA layers for the merged base layers, so the
+    textual cross attention runs a single matmul per projection. Only for inference, the LoRA weights are gone after.
+    """
+    for name, module in list(unet.named_modules()):
+        if isinstance(module, LoraLayer):
+            module.merge()
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(unet.get_submodule(parent_name), child_name, module.get_base_layer())
+    return unet
+
+
+def _lora_config_to_dict(lora_config):
+    """
+    Returns the LoRA config with builtin types only, so checkpoints can be loaded with `weights_only=True`.
+    """
+    config_dict = {}
+    for key, value in lora_config.to_dict().items():
+        if isinstance(value, Enum):
+            value = value.value
+        elif isinstance(value, set):
+            value = sorted(value)
+        config_dict[key] = value
+    return config_dict
+
+
 def save_progress(image_adapter, text_adapter, unet, accelerator, output_path, step=None, lora_config=None, optimizer=None):
     state_dict_image_adapter = accelerator.unwrap_model(image_adapter).state_dict()
     state_dict_text_adapter = accelerator.unwrap_model(text_adapter).state_dict()
-    state_dict_cross_attention = {}
-    unet_state_dict = accelerator.unwrap_model(unet).state_dict()
-    for key, value in unet_state_dict.items():
-        if "attn2" in key:
-            if "processor" in key or "to_q" in key or "to_k" in key or "to_v" in key:
-                state_dict_cross_attention[key] = value
+    state_dict_cross_attention = {
+        name: param.detach().cpu() for name, param in accelerator.unwrap_model(unet).named_parameters()
+        if CROSS_ATTENTION_PARAMETERS_PATTERN.search(name)
+    }
     final_state_dict = {
         "image_adapter": state_dict_image_adapter,
         "text_adapter": state_dict_text_adapter,
@@ -43,14 +91,19 @@ def save_progress(image_adapter, text_adapter, unet, accelerator, output_path, s
     if optimizer is not None:
         final_state_dict["optimizer"] = optimizer.state_dict()
     if lora_config is not None:
-        final_state_dict["lora_config"] = lora_config.to_dict()
+        final_state_dict["lora_config"] = _lora_config_to_dict(lora_config)
     if step is not None:
-        torch.save(final_state_dict, os.path.join(output_path, f"photoverse_{str(step).zfill(6)}.pt"))
+        checkpoint_path = os.path.join(output_path, f"photoverse_{str(step).zfill(6)}.pt")
     else:
-        torch.save(final_state_dict, os.path.join(output_path, "photoverse.pt"))
+        checkpoint_path = os.path.join(output_path, "photoverse.pt")
+    # Write to a temporary file first, so an interrupted save never leaves a truncated checkpoint behind
+    torch.save(final_state_dict, checkpoint_path + ".tmp")
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
 
 
-def load_models(pretrained_model_name_or_path, extra_num_tokens, photoverse_path=None, use_lora=False, lora_config=None):
+def load_models(pretrained_model_name_or_path, extra_num_tokens, photoverse_path=None, use_lora=False, lora_config=None,
+                compile_unet=False, compile_vae=False, compile_adapters=False, torch_dtype=None, merge_lora=False,
+                trust_legacy_checkpoint=False):
     # Load models and tokenizer
     tokenizer = CLIPTokenizer.from_pretrained(pretrained_model_name_or_path, subfolder="tokenizer")
     text_encoder = CLIPTextModel.from_pretrained(pretrained_model_name_or_path, subfolder="text_encoder")
@@ -80,6 +133,11 @@ def load_models(pretrained_model_name_or_path, extra_num_tokens, photoverse_path
     # Patch the text encoder
     text_encoder = patch_clip_text_transformer(text_encoder)
 
+    # Route the CLIP encoders attention through F.scaled_dot_product_attention (flash / memory efficient kernels),
+    # the U-Net attention processors already use it
+    text_encoder = patch_clip_attention_sdpa(text_encoder)
+    image_encoder = patch_clip_attention_sdpa(image_encoder)
+
     # set lora on textual cross attention layers add visual cross attention adapter
     unet = set_visual_cross_attention_adapter(unet, num_tokens=(extra_num_tokens + 1,))
 
@@ -89,7 +147,31 @@ def load_models(pretrained_model_name_or_path, extra_num_tokens, photoverse_path
 
     if photoverse_path is not None:
         # Load pretrained weights into models, if lora is used, it will overwrite the lora config
-        image_adapter, text_adapter, unet, lora_config = load_photoverse_model(photoverse_path, image_adapter, text_adapter, unet)
-
+        image_adapter, text_adapter, unet, lora_config = load_photoverse_model(
+            photoverse_path, image_adapter, text_adapter, unet, trust_legacy_checkpoint=trust_legacy_checkpoint)
+
+    # For inference only, LoRA is folded into the U-Net weights
+    if merge_lora and lora_config is not None:
+        unet = merge_lora_weights(unet)
+
+    # Channels last lets cuDNN pick tensor core convolution kernels without implicit layout transposes
+    unet.to(memory_format=torch.channels_last)
+    vae.to(memory_format=torch.channels_last)
+
+    # Inference in half precision: the VAE is kept in float32, since its decoder is unstable in float16
+    if torch_dtype is not None:
+        unet.to(dtype=torch_dtype)
+        image_encoder.to(dtype=torch_dtype)
+        image_adapter.to(dtype=torch_dtype)
+        text_adapter.to(dtype=torch_dtype)
+
+    # Compile last, so the adapters and pretrained weights are already in place
+    if compile_unet:
+        unet = torch.compile(unet, mode="reduce-overhead", fullgraph=False)
+    if compile_vae:
+        vae.decode = torch.compile(vae.decode, mode="reduce-overhead")
+    if compile_adapters:
+        image_adapter.compile_fused_layers()
+        text_adapter.compile_fused_layers()
 
     return tokenizer, text_encoder, vae, unet, image_encoder, image_adapter, text_adapter, scheduler, lora_config
\ No newline at end of file
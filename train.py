@@ -48,6 +48,12 @@ def parse_args():
         default=None,
         help="Path to pretrained ip adapter model. If not specified weights are initialized randomly.",
     )
+    parser.add_argument(
+        "--trust_legacy_checkpoint",
+        action="store_true",
+        help="Allow fully unpickling an older pretrained photoverse checkpoint that fails to load with weights_only=True."
+             " Only use it with checkpoints from a trusted source.",
+    )
     parser.add_argument(
         "--data_root_path",
         type=str,
@@ -360,6 +366,7 @@ def main():
         photoverse_path=args.pretrained_photoverse_path,
         use_lora=args.use_lora,
         lora_config=lora_config,
+        trust_legacy_checkpoint=args.trust_legacy_checkpoint,
     )
 
     # optimizer
@@ -400,6 +407,7 @@ def main():
         collate_fn=collate_fn,
         batch_size=args.train_batch_size,
         num_workers=args.dataloader_num_workers,
+        pin_memory=True,
     )
 
     override_max_train_steps = False